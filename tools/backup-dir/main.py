@@ -1,16 +1,23 @@
 #!/usr/bin/env python3
 """
-GitAwareBackup: A tool to create compressed backups of directories using git archive.
-Creates a temporary git repository to respect .gitignore patterns.
+GitAwareBackup: A tool to create compressed backups of directories using git.
+Creates a temporary git repository (via libgit2) to respect .gitignore patterns.
 """
 
+import io
 import os
 import sys
 import argparse
 import logging
 from datetime import datetime
-import subprocess
+import glob
 import shutil
+import subprocess
+import tarfile
+import threading
+import uuid
+
+import pygit2
 
 # Set up logging
 logging.basicConfig(
@@ -20,14 +27,19 @@ logging.basicConfig(
 )
 logger = logging.getLogger("git-aware-backup")
 
+# Write buffer for the pigz stdin pipe and the in-process gzip output file
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+
 
 class GitAwareBackup:
-    """Creates backups using git archive."""
+    """Creates backups using an in-process git repository."""
     
-    def __init__(self, source_dir: str, output_file: str = None, verbose: bool = False):
+    def __init__(self, source_dir: str, output_file: str = None, verbose: bool = False,
+                 compresslevel: int = 6):
         """Initialize the backup tool."""
         self.source_dir = os.path.abspath(source_dir)
         self.verbose = verbose
+        self.compresslevel = compresslevel
         
         if verbose:
             logger.setLevel(logging.DEBUG)
@@ -35,44 +47,171 @@ class GitAwareBackup:
         if not os.path.isdir(self.source_dir):
             raise ValueError(f"Source directory '{self.source_dir}' does not exist")
         
-        self.output_file = output_file or f"{os.path.basename(self.source_dir)}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+        if not 0 <= compresslevel <= 9:
+            raise ValueError(f"Compression level must be between 0 and 9, got {compresslevel}")
+        
+        self.output_file = output_file or f"{os.path.basename(self.source_dir)}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.tar.gz"
     
-    def _run_git_command(self, args: list) -> subprocess.CompletedProcess:
-        """Run a git command in the source directory."""
+    def _add_excludes(self, repo: pygit2.Repository, patterns: list) -> None:
+        """Append ignore patterns to the temporary repository's info/exclude file."""
+        info_dir = os.path.join(repo.path, 'info')
+        os.makedirs(info_dir, exist_ok=True)
+        with open(os.path.join(info_dir, 'exclude'), 'a') as f:
+            f.writelines(f"{pattern}\n" for pattern in patterns)
+    
+    def _find_nested_repos(self, repo: pygit2.Repository) -> list:
+        """Find directories below the source root that hold their own git repository."""
+        nested = []
+        for root, dirs, files in os.walk(self.source_dir):
+            rel_root = os.path.relpath(root, self.source_dir).replace(os.sep, '/')
+            if rel_root != '.' and ('.git' in dirs or '.git' in files):
+                nested.append(rel_root)
+                dirs[:] = []
+                continue
+            prefix = '' if rel_root == '.' else f"{rel_root}/"
+            dirs[:] = [d for d in dirs if d != '.git' and not repo.path_is_ignored(f"{prefix}{d}/")]
+        return nested
+    
+    def _stage_nested_repos(self, repo: pygit2.Repository) -> None:
+        """Stage nested repositories as gitlinks, which libgit2's add_all refuses to do."""
+        nested = self._find_nested_repos(repo)
+        if not nested:
+            return
+        # Keep add_all from descending into them
+        self._add_excludes(repo, [f"/{glob.escape(path)}/" for path in nested])
+        for path in nested:
+            try:
+                head = pygit2.Repository(os.path.join(self.source_dir, path)).head.target
+            except pygit2.GitError:
+                logger.warning(f"Skipping nested git repository without commits: {path}")
+                continue
+            logger.warning(f"Nested git repository {path} is backed up as an empty directory")
+            repo.index.add(pygit2.IndexEntry(path, head, pygit2.GIT_FILEMODE_COMMIT))
+    
+    def _add_index_entries(self, repo: pygit2.Repository, archive: tarfile.TarFile) -> None:
+        """
+        Add every entry staged in the repository index to a tar archive.
+        
+        Directories get their own entries, as with git archive. Each file is
+        read from the object store whole, so memory use peaks at the size of
+        the largest file in the backup.
+        """
+        mtime = int(datetime.now().timestamp())
+        
+        def new_info(name: str) -> tarfile.TarInfo:
+            info = tarfile.TarInfo(name)
+            info.mtime = mtime
+            info.uname = info.gname = 'root'
+            return info
+        
+        def add_dir(name: str) -> None:
+            info = new_info(name)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            archive.addfile(info)
+            written_dirs.add(name)
+        
+        written_dirs = set()
+        for entry in repo.index:
+            parts = entry.path.split('/')
+            for depth in range(1, len(parts)):
+                parent = '/'.join(parts[:depth])
+                if parent not in written_dirs:
+                    add_dir(parent)
+            if entry.mode == pygit2.GIT_FILEMODE_COMMIT:
+                # Nested repositories have no local objects, archive them as empty directories like git does
+                add_dir(entry.path)
+                continue
+            info = new_info(entry.path)
+            content = repo[entry.id].data
+            if entry.mode == pygit2.GIT_FILEMODE_LINK:
+                info.type = tarfile.SYMTYPE
+                info.linkname = os.fsdecode(content)
+                info.mode = 0o777
+                archive.addfile(info)
+            else:
+                info.size = len(content)
+                info.mode = entry.mode & 0o777
+                archive.addfile(info, io.BytesIO(content))
+    
+    def _write_archive(self, repo: pygit2.Repository, output_path: str) -> None:
+        """Write the repository index to a gzipped tar archive, compressing with pigz when available."""
+        pigz = shutil.which('pigz')
+        if pigz is None:
+            logger.debug("pigz not found, compressing in-process")
+            with open(output_path, 'wb', buffering=WRITE_BUFFER_SIZE) as output:
+                with tarfile.open(fileobj=output, mode='w:gz', compresslevel=self.compresslevel) as archive:
+                    self._add_index_entries(repo, archive)
+            return
+        
+        args = [pigz, '-p', str(os.cpu_count() or 1), f'-{self.compresslevel}']
         if self.verbose:
-            logger.debug(f"Running command: git {' '.join(args)}")
-        return subprocess.run(['git'] + args, cwd=self.source_dir, check=True, capture_output=True)
+            logger.debug(f"Running command: {' '.join(args)}")
+        # pigz writes to the output file descriptor directly, only its stdin pipe is buffered
+        with open(output_path, 'wb') as output:
+            proc = subprocess.Popen(args, bufsize=WRITE_BUFFER_SIZE, stdin=subprocess.PIPE, stdout=output)
+        broken_pipe = None
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode='w|') as archive:
+                self._add_index_entries(repo, archive)
+            proc.stdin.close()
+        except BrokenPipeError as e:
+            # pigz exited early, its exit status below is the meaningful error
+            broken_pipe = e
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError as e:
+                broken_pipe = broken_pipe or e
+            returncode = proc.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args)
+        if broken_pipe is not None:
+            raise broken_pipe
+    
+    def _remove_git_dir(self) -> None:
+        """Move the temporary git directory out of the way and delete it in the background."""
+        git_dir = os.path.join(self.source_dir, '.git')
+        if not os.path.exists(git_dir):
+            return
+        trash_dir = os.path.join(self.source_dir, f'.git.todelete.{uuid.uuid4().hex}')
+        os.rename(git_dir, trash_dir)
+        # Non-daemon so the interpreter waits for the deletion before exiting
+        threading.Thread(target=shutil.rmtree, args=(trash_dir,), daemon=False).start()
     
     def create_backup(self) -> str:
-        """Create a compressed backup of the directory using git archive."""
+        """Create a compressed backup of the directory using a temporary git index."""
         start_time = datetime.now()
         logger.info(f"Starting backup of {self.source_dir} to {self.output_file}")
         
         try:
             # Initialize temporary git repository
             logger.info("Initializing temporary git repository...")
-            self._run_git_command(['init'])
+            repo = pygit2.init_repository(self.source_dir)
             
             # Stage all files (respecting .gitignore)
             logger.info("Staging files...")
-            self._run_git_command(['add', '.'])
-            
-            # Create initial commit
-            logger.info("Creating initial commit...")
-            self._run_git_command(['commit', '-m', 'Temporary commit for backup'])
+            # Leftovers from an interrupted background cleanup must not end up in the backup
+            self._add_excludes(repo, ['/.git.todelete.*/'])
+            try:
+                repo.index.add_all()
+            except pygit2.GitError as e:
+                # libgit2 refuses to descend into nested repositories, stage them ourselves and retry
+                if 'invalid path' not in str(e):
+                    raise
+                self._stage_nested_repos(repo)
+                repo.index.add_all()
             
             # Create the output file in the current directory
             output_path = os.path.abspath(self.output_file)
             
-            # Create archive
+            # Create archive straight from the index, no commit needed
             logger.info("Creating archive...")
-            self._run_git_command(['archive', '--format=zip', '-o', output_path, 'HEAD'])
+            self._write_archive(repo, output_path)
             
             # Clean up temporary git repository
             logger.info("Cleaning up temporary git repository...")
-            git_dir = os.path.join(self.source_dir, '.git')
-            if os.path.exists(git_dir):
-                shutil.rmtree(git_dir)
+            self._remove_git_dir()
             
             duration = (datetime.now() - start_time).total_seconds()
             backup_size = os.path.getsize(output_path) / (1024 * 1024)
@@ -84,9 +223,7 @@ class GitAwareBackup:
         except Exception as e:
             logger.error(f"Backup failed: {str(e)}")
             # Clean up git repository in case of failure
-            git_dir = os.path.join(self.source_dir, '.git')
-            if os.path.exists(git_dir):
-                shutil.rmtree(git_dir)
+            self._remove_git_dir()
             if os.path.exists(self.output_file):
                 try:
                     os.remove(self.output_file)
@@ -98,15 +235,17 @@ class GitAwareBackup:
 
 def main():
     """Command-line interface for GitAwareBackup."""
-    parser = argparse.ArgumentParser(description='Create a compressed backup using git archive')
+    parser = argparse.ArgumentParser(description='Create a compressed backup respecting .gitignore patterns')
     parser.add_argument('source', help='Source directory to backup')
-    parser.add_argument('-o', '--output', help='Output file name (default: source_timestamp.zip)')
+    parser.add_argument('-o', '--output', help='Output file name (default: source_timestamp.tar.gz)')
+    parser.add_argument('-l', '--compresslevel', type=int, default=6,
+                        help='Compression level from 0 (store) to 9 (best) (default: 6)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
     
     args = parser.parse_args()
     
     try:
-        backup_tool = GitAwareBackup(args.source, args.output, args.verbose)
+        backup_tool = GitAwareBackup(args.source, args.output, args.verbose, args.compresslevel)
         backup_file = backup_tool.create_backup()
         logger.info(f"Backup created: {backup_file}")
         return 0
@@ -3,14 +3,53 @@ from functools import partial
 import gradio as gr
 import torch
 import torchaudio
+import torchaudio.functional as AF
 
-from resemble_enhance.enhancer.inference import denoise, enhance
+from resemble_enhance.enhancer.inference import denoise, load_enhancer
+from resemble_enhance.inference import inference
 
 if torch.cuda.is_available():
     device = "cuda"
 else:
     device = "cpu"
 
+# Sample rate the enhancer runs at
+WAV_RATE = 44100
+
+_model = None
+
+
+def _run_in_fp32(module):
+    forward = module.forward
+
+    def _forward(x, *args, **kwargs):
+        with torch.autocast(device_type=device, enabled=False):
+            return forward(x.float(), *args, **kwargs)
+
+    module.forward = _forward
+
+
+def _get_model():
+    global _model
+    if _model is None:
+        model = load_enhancer(None, device)
+        if device == "cuda":
+            # The vocoder's output layer produces the waveform, keep it out of bf16
+            for name, module in model.named_modules():
+                if name.rsplit(".", 1)[-1] == "conv_post":
+                    _run_in_fp32(module)
+            # Dynamic shapes cover varying input lengths. Changing the solver or NFE still
+            # recompiles, and past dynamo's recompile limit the model silently runs eagerly.
+            model = torch.compile(model, dynamic=True)
+        _model = model
+    return _model
+
+
+def _enhance(dwav, solver, nfe, lambd, tau):
+    model = _get_model()
+    model.configurate_(nfe=nfe, solver=solver, lambd=lambd, tau=tau)
+    return inference(model=model, dwav=dwav, sr=WAV_RATE, device=device)
+
 
 def _fn(path, solver, nfe, tau, denoising):
     if path is None:
@@ -24,14 +63,40 @@ def _fn(path, solver, nfe, tau, denoising):
     dwav, sr = torchaudio.load(path)
     dwav = dwav.mean(dim=0)
 
-    wav2, new_sr = enhance(dwav, sr, device, nfe=nfe, solver=solver, lambd=lambd, tau=tau)
+    # Resample in fp32 outside autocast, with the same filter inference uses, so its own resample is a no-op
+    dwav = AF.resample(
+        dwav,
+        orig_freq=sr,
+        new_freq=WAV_RATE,
+        lowpass_filter_width=64,
+        rolloff=0.9475937167399596,
+        resampling_method="sinc_interp_kaiser",
+        beta=14.769656459379492,
+    )
+
+    if device == "cuda":
+        # inference moves each chunk to the device itself, pinned chunks are copied without a staging buffer
+        dwav = dwav.contiguous().pin_memory()
 
-    wav2 = wav2.cpu().numpy()
+    with torch.inference_mode(), torch.autocast(device_type=device, dtype=torch.bfloat16, enabled=device == "cuda"):
+        wav2, new_sr = _enhance(dwav, solver, nfe, lambd, tau)
+
+    wav2 = wav2.float().numpy()
 
     return (new_sr, wav2)
 
 
+def _warmup():
+    # Load the model, initialize CUDA and trace the default settings ahead of the first request
+    dwav = torch.zeros(WAV_RATE).pin_memory()
+    with torch.inference_mode(), torch.autocast(device_type=device, dtype=torch.bfloat16):
+        _enhance(dwav, "midpoint", 64, lambd=0.1, tau=0.5)
+
+
 def main():
+    if device == "cuda":
+        _warmup()
+
     inputs: list = [
         gr.Audio(type="filepath", label="Input Audio"),
         gr.Dropdown(